@@ -12,15 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import logging
 import os
 
-from google.cloud import pubsub
+import orjson
+
+# The environment is fixed for the lifetime of the instance, so the topic
+# name can be derived once at load time.
+FQTN = 'projects/{}/topics/{}'.format(os.environ.get('GCP_PROJECT'),
+                                      os.environ.get('ALERT_TOPIC'))
 
 publish_client = None
 
 
+def _publisher():
+  """Import and construct the batching publisher on first alert.
+
+  Alerts are the rare case; deferring the pubsub import and client
+  construction keeps instances that only ever see passing documents from
+  paying for either.
+  """
+  global publish_client
+  if publish_client is None:
+    from google.cloud import pubsub
+    publish_client = pubsub.PublisherClient(
+        batch_settings=pubsub.types.BatchSettings(
+            max_messages=100, max_latency=0.05, max_bytes=1024 * 1024))
+  return publish_client
+
+
 def generate_alert(data, context):
   """Cloud Function entry point, triggered by a change to a Firestore document.
 
@@ -31,17 +51,15 @@ def generate_alert(data, context):
     data (dict): The event payload.
     context (google.cloud.functions.Context): Metadata for the event.
   """
-  doc_fields = data['value']['fields']
-  status = doc_fields['status']['stringValue']
-  if 'FAIL' in status:
-    global publish_client
-    if not publish_client:
-      publish_client = pubsub.PublisherClient()
-
-    logging.info('Sending alert in response to %s status in document %s',
-                 status, context.resource)
-    project = os.environ.get('GCP_PROJECT')
-    topic = os.environ.get('ALERT_TOPIC')
-    fqtn = 'projects/{}/topics/{}'.format(project, topic)
-    msg = json.dumps(data['value']).encode('utf-8')
-    publish_client.publish(fqtn, msg)
+  # Firestore triggers can't filter on field values, so this function runs
+  # for every new document; return immediately unless the analysis failed
+  status = data['value']['fields']['status']['stringValue']
+  if status != 'FAIL':
+    return
+
+  logging.info('Sending alert in response to %s status in document %s',
+               status, context.resource)
+  msg = orjson.dumps(data['value'])
+  # deliberately don't wait on the returned future; the batching client
+  # sends the message in the background
+  _publisher().publish(FQTN, msg)